@@ -66,12 +66,11 @@ def cli():
         host_dsos_paths: list[str] = [args.driver_directory]
     else:
         log_info("Retrieving DSOs from the load path.")
-        host_dsos_paths: list[str] = get_ld_paths()
+        host_dsos_paths: list[str] = list(get_ld_paths())
     new_env = nvidia_main(cache_dir, host_dsos_paths, args.print_ld_library_path)
     log_info(f"{time.time() - start_time} seconds elapsed since script start.")
     if args.NIX_BINARY:
-        os.environ.update(new_env)
-        exec_binary(args.NIX_BINARY, args.ARGS)
+        exec_binary(args.NIX_BINARY, args.ARGS, env={**os.environ, **new_env})
     return 0
 
 
@@ -1,24 +1,34 @@
+import functools
 import hashlib
 import json
 import os
-import re
-import shutil
-import stat
-import subprocess
 import sys
+from collections.abc import Iterator
+from dataclasses import dataclass, field
 from glob import glob
 
-from nixglhost.util import log_info
+from nixglhost.util import DEBUG, log_info
+
+try:
+    # Optional, faster JSON (de)serialization.
+    import orjson
+except ImportError:
+    orjson = None
 
 __all__ = [
     "ResolvedLib",
     "LibraryPath",
     "CacheDirContent",
     "get_ld_paths",
+    "get_dso_stem",
     "resolve_libraries",
-    "copy_and_patch_libs",
+    "copy_libs",
+    "copy_dso",
     "patch_dsos",
+    "read_cache_content",
     "is_dso_cache_up_to_date",
+    "hash_dso_content",
+    "library_path_hash",
     "cache_library_path",
     "generate_cache_ld_library_path",
     "generate_cache_metadata",
@@ -26,7 +36,7 @@ __all__ = [
 ]
 
 IN_NIX_STORE = False
-CACHE_VERSION = 3
+CACHE_VERSION = 4
 
 if IN_NIX_STORE:
     # The following paths are meant to be substituted by Nix at build
@@ -36,28 +46,25 @@ else:
     PATCHELF_PATH = "patchelf"
 
 
+@dataclass(frozen=True, slots=True, repr=False)
 class ResolvedLib:
     """This data type encapsulate one host dynamically shared object
     together with some metadata helping us to uniquely identify it."""
 
-    def __init__(
-        self,
-        name: str,
-        dirpath: str,
-        fullpath: str,
-        last_modification: float | None = None,
-        size: int | None = None,
-    ):
-        self.name: str = name
-        self.dirpath: str = dirpath
-        self.fullpath: str = fullpath
-        if size is None or last_modification is None:
-            stat = os.stat(fullpath)
-            self.last_modification: float = stat.st_mtime
-            self.size: int = stat.st_size
-        else:
-            self.last_modification = last_modification
-            self.size = size
+    name: str
+    dirpath: str
+    fullpath: str
+    last_modification: float
+    size: int
+    # Lazily computed, see get_content_hash. It's not part of the DSO
+    # identity.
+    content_hash: str | None = field(default=None, compare=False)
+
+    @classmethod
+    def from_path(cls, name: str, dirpath: str, fullpath: str):
+        """Resolves the DSO metadata from the filesystem."""
+        stat = os.stat(fullpath)
+        return cls(name, dirpath, fullpath, stat.st_mtime, stat.st_size)
 
     def __repr__(self):
         return f"ResolvedLib<{self.name}, {self.dirpath}, {self.fullpath}, {self.last_modification}, {self.size}>"
@@ -69,69 +76,102 @@ class ResolvedLib:
             "fullpath": self.fullpath,
             "last_modification": self.last_modification,
             "size": self.size,
+            "content_hash": self.content_hash,
         }
 
-    def __hash__(self):
-        return hash(
-            (self.name, self.dirpath, self.fullpath, self.last_modification, self.size)
-        )
-
-    def __eq__(self, o):
-        return (
-            self.name == o.name
-            and self.fullpath == o.fullpath
-            and self.dirpath == o.dirpath
-            and self.last_modification == o.last_modification
-            and self.size == o.size
-        )
+    def get_content_hash(self) -> str:
+        """Returns the hash of the DSO content, computing it if we
+        don't know it yet."""
+        if self.content_hash is None:
+            # The content hash is a cache, not part of the object
+            # identity: it's fine to bypass the frozen dataclass.
+            object.__setattr__(self, "content_hash", hash_dso_content(self.fullpath))
+        return self.content_hash
+
+    def is_up_to_date(self, cached: "ResolvedLib") -> bool:
+        """Check whether the CACHED DSO is still matching this DSO.
+
+        We first compare the DSOs metadata. If only the modification
+        time differs, we fall back to comparing their content
+        hashes. This saves us from re-caching DSOs that have been
+        touched without being modified.
+
+        The CACHED content hash is carried over: it'll be persisted
+        to the cache the next time we write it."""
+        if (
+            self.name != cached.name
+            or self.fullpath != cached.fullpath
+            or self.dirpath != cached.dirpath
+            or self.size != cached.size
+        ):
+            return False
+        if self.last_modification == cached.last_modification:
+            if self.content_hash is None:
+                object.__setattr__(self, "content_hash", cached.content_hash)
+            return True
+        if cached.content_hash is None:
+            return False
+        log_info(f"{self.fullpath} modification time changed, hashing it")
+        return self.get_content_hash() == cached.content_hash
 
     @classmethod
     def from_dict(cls, d: dict):
         return ResolvedLib(
-            d["name"], d["dirpath"], d["fullpath"], d["last_modification"], d["size"]
+            d["name"],
+            d["dirpath"],
+            d["fullpath"],
+            d["last_modification"],
+            d["size"],
+            d.get("content_hash"),
         )
 
 
+@dataclass(frozen=True, slots=True, repr=False)
 class LibraryPath:
     """This data type encapsulates a directory containing some GL/Cuda
     dynamically shared objects."""
 
-    def __init__(
-        self,
-        glx: list[ResolvedLib],
-        cuda: list[ResolvedLib],
-        generic: list[ResolvedLib],
-        egl: list[ResolvedLib],
-        path: str,
-    ):
-        self.glx = glx
-        self.cuda = cuda
-        self.generic = generic
-        self.egl = egl
-        self.path = path
-
-    def __eq__(self, other):
-        return (
-            set(self.glx) == set(other.glx)
-            and set(self.cuda) == set(other.cuda)
-            and set(self.generic) == set(other.generic)
-            and set(self.egl) == set(other.egl)
-            and self.path == other.path
-        )
+    glx: tuple[ResolvedLib, ...]
+    cuda: tuple[ResolvedLib, ...]
+    generic: tuple[ResolvedLib, ...]
+    egl: tuple[ResolvedLib, ...]
+    path: str
+
+    def __post_init__(self):
+        # The DSOs order does not matter when comparing two library
+        # paths: we're normalizing it.
+        for category in ["glx", "cuda", "generic", "egl"]:
+            object.__setattr__(
+                self,
+                category,
+                tuple(sorted(getattr(self, category), key=lambda dso: dso.fullpath)),
+            )
 
     def __repr__(self):
         return f"LibraryPath<{self.path}>"
 
-    def __hash__(self):
-        return hash(
-            (
-                tuple(self.glx),
-                tuple(self.cuda),
-                tuple(self.generic),
-                tuple(self.egl),
-                self.path,
-            )
-        )
+    def all_dsos(self) -> tuple[ResolvedLib, ...]:
+        return self.glx + self.cuda + self.generic + self.egl
+
+    def is_up_to_date(self, cached: "LibraryPath") -> bool:
+        """Check whether the CACHED library path is still matching
+        this one. See ResolvedLib.is_up_to_date."""
+        if self.path != cached.path:
+            return False
+        for dsos, cached_dsos in [
+            (self.glx, cached.glx),
+            (self.cuda, cached.cuda),
+            (self.generic, cached.generic),
+            (self.egl, cached.egl),
+        ]:
+            cached_by_path = {dso.fullpath: dso for dso in cached_dsos}
+            if len(dsos) != len(cached_by_path):
+                return False
+            for dso in dsos:
+                cached_dso = cached_by_path.get(dso.fullpath)
+                if cached_dso is None or not dso.is_up_to_date(cached_dso):
+                    return False
+        return True
 
     def to_dict(self) -> dict:
         return {
@@ -145,10 +185,10 @@ class LibraryPath:
     @classmethod
     def from_dict(cls, d: dict):
         return LibraryPath(
-            glx=[ResolvedLib.from_dict(v) for v in d["glx"]],
-            cuda=[ResolvedLib.from_dict(v) for v in d["cuda"]],
-            generic=[ResolvedLib.from_dict(v) for v in d["generic"]],
-            egl=[ResolvedLib.from_dict(v) for v in d["egl"]],
+            glx=tuple(ResolvedLib.from_dict(v) for v in d["glx"]),
+            cuda=tuple(ResolvedLib.from_dict(v) for v in d["cuda"]),
+            generic=tuple(ResolvedLib.from_dict(v) for v in d["generic"]),
+            egl=tuple(ResolvedLib.from_dict(v) for v in d["egl"]),
             path=d["path"],
         )
 
@@ -157,36 +197,80 @@ class CacheDirContent:
     """This datatype encapsulates all the dynamically shared objects
     living in the nix-gl-host cache. We mostly use it to serialize
     what's in the cache on the disk and compare this content to what
-    we scanned in the host system."""
+    we scanned in the host system.
+
+    We also store the LD_LIBRARY_PATH pointing to the cached DSOs:
+    it's the only thing we need to read from the cache when it's up
+    to date."""
 
-    def __init__(self, paths: list[LibraryPath], version: int = CACHE_VERSION):
+    def __init__(
+        self,
+        paths: list[LibraryPath],
+        version: int = CACHE_VERSION,
+        ld_library_path: str | None = None,
+    ):
         self.paths: list[LibraryPath] = paths
         self.version: int = version
+        self.ld_library_path: str | None = ld_library_path
 
     def to_json(self):
-        d = {"paths": [p.to_dict() for p in self.paths], "version": self.version}
-        return json.dumps(d, sort_keys=True)
+        d = {
+            "paths": [p.to_dict() for p in self.paths],
+            "version": self.version,
+            "ld_library_path": self.ld_library_path,
+        }
+        if orjson is not None:
+            return orjson.dumps(d).decode("utf8")
+        return json.dumps(d)
 
     def __eq__(self, o):
         return self.version == o.version and set(self.paths) == set(o.paths)
 
+    def diff(
+        self, cached: "CacheDirContent"
+    ) -> tuple[list[LibraryPath], list[LibraryPath], list[LibraryPath]]:
+        """Compares the library paths we scanned to the CACHED ones.
+
+        Returns a (stale, fresh, removed) tuple:
+
+        - stale: the library paths that have to be (re-)cached.
+        - fresh: the library paths whose cache can be re-used as is.
+        - removed: the CACHED library paths that do not exist anymore.
+
+        Every library path is considered to be stale if the cache
+        format version changed."""
+        paths = {p.path: p for p in self.paths}
+        cached_paths = {p.path: p for p in cached.paths}
+        if self.version != cached.version:
+            return (list(paths.values()), [], list(cached_paths.values()))
+        stale: list[LibraryPath] = []
+        fresh: list[LibraryPath] = []
+        for path, library_path in paths.items():
+            cached_path = cached_paths.get(path)
+            if cached_path is not None and library_path.is_up_to_date(cached_path):
+                fresh.append(library_path)
+            else:
+                stale.append(library_path)
+        removed = [p for path, p in cached_paths.items() if path not in paths]
+        return (stale, fresh, removed)
+
     @classmethod
     def from_json(cls, j: str):
-        d: dict = json.loads(j)
+        d: dict = orjson.loads(j) if orjson is not None else json.loads(j)
         return CacheDirContent(
-            version=d["version"], paths=[LibraryPath.from_dict(p) for p in d["paths"]]
+            version=d["version"],
+            paths=[LibraryPath.from_dict(p) for p in d["paths"]],
+            ld_library_path=d.get("ld_library_path"),
         )
 
 
-def get_ld_paths() -> list[str]:
-    """
-    Vendored from https://github.com/albertz/system-tools/blob/master/bin/find-lib-in-path.py
-
-    Find all the directories pointed by LD_LIBRARY_PATH and the ld cache."""
+def parse_ld_conf_file(fn: str) -> Iterator[str]:
+    """Parses the FN ld.so.conf file, recursively following its
+    include directives.
 
-    def parse_ld_conf_file(fn: str) -> list[str]:
-        paths = []
-        for l in open(fn).read().splitlines():
+    Yields the library paths listed in there."""
+    with open(fn) as f:
+        for l in f:
             l = l.strip()
             if not l:
                 continue
@@ -197,10 +281,20 @@ def get_ld_paths() -> list[str]:
                 if dirglob[0] != "/":
                     dirglob = os.path.dirname(os.path.normpath(fn)) + "/" + dirglob
                 for sub_fn in glob(dirglob):
-                    paths.extend(parse_ld_conf_file(sub_fn))
+                    yield from parse_ld_conf_file(sub_fn)
                 continue
-            paths.append(l)
-        return paths
+            yield l
+
+
+@functools.lru_cache(maxsize=None)
+def get_ld_paths() -> tuple[str, ...]:
+    """
+    Vendored from https://github.com/albertz/system-tools/blob/master/bin/find-lib-in-path.py
+
+    Find all the directories pointed by LD_LIBRARY_PATH and the ld cache.
+
+    The environment is not supposed to change during the process
+    lifetime: the result is memoized."""
 
     LDPATH = os.getenv("LD_LIBRARY_PATH")
     PREFIX = os.getenv("PREFIX")  # Termux & etc.
@@ -228,62 +322,123 @@ def get_ld_paths() -> list[str]:
             ]
         )
     paths.extend(["/lib", "/usr/lib", "/lib64", "/usr/lib64"])
-    return [path for path in paths if os.path.isdir(path)]
+    # Removing the duplicate paths, preserving their order.
+    return tuple(path for path in dict.fromkeys(paths) if os.path.isdir(path))
 
 
-def resolve_libraries(path: str, files_patterns: list[str]) -> list[ResolvedLib]:
-    """Scans the PATH directory looking for the files complying with
-    the FILES_PATTERNS regexes list.
+def get_dso_stem(name: str) -> str | None:
+    """Returns the NAME DSO file name stripped from its .so extension
+    and its version suffix. IE. libcuda.so.1 => libcuda.
 
-    Returns the list of the resolved DSOs."""
-    libraries: list[ResolvedLib] = []
+    Returns None if NAME is not a DSO file name."""
+    stem, sep, _ = name.partition(".so")
+    return stem if sep else None
 
-    def is_dso_matching_pattern(filename):
-        for pattern in files_patterns:
-            if re.search(pattern, filename):
-                return True
-        return False
 
-    for fname in os.listdir(path):
-        abs_file_path = os.path.abspath(os.path.join(path, fname))
-        if os.path.isfile(abs_file_path) and is_dso_matching_pattern(abs_file_path):
-            libraries.append(
-                ResolvedLib(name=fname, dirpath=path, fullpath=abs_file_path)
-            )
+def resolve_libraries(path: str, files_prefixes: frozenset[str]) -> list[ResolvedLib]:
+    """Scans the PATH directory looking for the DSOs whose name stem
+    (see get_dso_stem) belongs to FILES_PREFIXES.
+
+    Returns the list of the resolved DSOs."""
+    libraries: list[ResolvedLib] = []
+    abs_path = os.path.abspath(path)
+    with os.scandir(path) as it:
+        for entry in it:
+            if get_dso_stem(entry.name) in files_prefixes and entry.is_file():
+                st = entry.stat()
+                libraries.append(
+                    ResolvedLib(
+                        name=entry.name,
+                        dirpath=path,
+                        fullpath=os.path.join(abs_path, entry.name),
+                        last_modification=st.st_mtime,
+                        size=st.st_size,
+                    )
+                )
     return libraries
 
 
-def copy_and_patch_libs(
-    dsos: list[ResolvedLib], dest_dir: str, rpath: str | None = None
-) -> None:
-    """Copies the graphic vendor DSOs to the cache directory before
-    patchelf-ing them.
+def copy_libs(
+    dsos: tuple[ResolvedLib, ...],
+    dest_dir: str,
+    cached_dsos: tuple[ResolvedLib, ...] | None = None,
+    cached_dir: str | None = None,
+) -> list[str]:
+    """Copies the graphic vendor DSOs to the cache directory.
 
     The DSOs can dlopen each other. Sadly, we don't want any host
     libraries to the LD_LIBRARY_PATH to prevent polluting the nix
     binary env. The only option left is to patch their ELFs runpath to
-    point to RPATH.
+    point to the cache directory.
 
     We also don't want to directly modify the host DSOs. In the end,
     we first copy them to the user's personal cache directory, we then
-    alter their runpath to point to the cache directory."""
-    rpath = rpath if (rpath is not None) else dest_dir
+    alter their runpath (see patch_dsos).
+
+    The DSOs that did not change since they got copied and patched to
+    CACHED_DIR (described by CACHED_DSOS) are hardlinked from there
+    instead.
+
+    Returns the paths of the copies that need to be patched."""
+    cached_by_path = {dso.fullpath: dso for dso in cached_dsos or []}
     new_paths: list[str] = []
     for dso in dsos:
         basename = os.path.basename(dso.fullpath)
         newpath = os.path.join(dest_dir, basename)
-        log_info(f"Copying and patching {dso} to {newpath}")
-        shutil.copyfile(dso.fullpath, newpath)
-        # Provide write permissions to ensure we can patch this binary.
-        os.chmod(newpath, os.stat(dso.fullpath).st_mode | stat.S_IWUSR)
+        cached_dso = cached_by_path.get(dso.fullpath)
+        if (
+            cached_dir is not None
+            and cached_dso is not None
+            and dso.is_up_to_date(cached_dso)
+        ):
+            try:
+                os.link(os.path.join(cached_dir, basename), newpath)
+                if DEBUG:
+                    log_info(f"Re-using the patched {dso} from {cached_dir}")
+                continue
+            except OSError as e:
+                log_info(f"Cannot re-use the patched {dso}: {e}")
+        # Hot loop: we don't want to format the message for nothing.
+        if DEBUG:
+            log_info(f"Copying {dso} to {newpath}")
+        copy_dso(dso, newpath)
         new_paths.append(newpath)
-    patch_dsos(new_paths, rpath)
+    return new_paths
+
+
+def copy_dso(dso: ResolvedLib, newpath: str) -> None:
+    """Copies the DSO host file to NEWPATH.
+
+    We already know the DSO size, there's no need to stat it again:
+    the copy is directly performed by the kernel through sendfile.
+    The copy is created user-writable to ensure we can patch it."""
+    src = os.open(dso.fullpath, os.O_RDONLY | os.O_CLOEXEC)
+    try:
+        dst = os.open(
+            newpath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_CLOEXEC, 0o644
+        )
+        try:
+            remaining = dso.size
+            while remaining > 0:
+                sent = os.sendfile(dst, src, None, remaining)
+                if sent == 0:
+                    break
+                remaining -= sent
+        finally:
+            os.close(dst)
+    finally:
+        os.close(src)
 
 
 def patch_dsos(dsoPaths: list[str], rpath: str) -> None:
     """Call patchelf to change the DSOS runpath with RPATH."""
-    log_info(f"Patching {dsoPaths}")
-    log_info(f"Exec: {PATCHELF_PATH} --set-rpath {rpath} {dsoPaths}")
+    if DEBUG:
+        log_info(f"Patching {dsoPaths}")
+        log_info(f"Exec: {PATCHELF_PATH} --set-rpath {rpath} {dsoPaths}")
+    # Only needed when the cache is stale, we're not paying for this
+    # import on a warm cache run.
+    import subprocess
+
     res = subprocess.run([PATCHELF_PATH, "--set-rpath", rpath] + dsoPaths)
     if res.returncode != 0:
         raise BaseException(
@@ -291,26 +446,62 @@ def patch_dsos(dsoPaths: list[str], rpath: str) -> None:
         )
 
 
+def read_cache_content(cache_file_path: str) -> CacheDirContent | None:
+    """Loads the cache content description stored at CACHE_FILE_PATH.
+
+    Returns None if the file does not exist or cannot be parsed."""
+    if os.path.isfile(cache_file_path):
+        with open(cache_file_path, "r", encoding="utf8") as f:
+            try:
+                return CacheDirContent.from_json(f.read())
+            except:
+                return None
+    return None
+
+
 def is_dso_cache_up_to_date(dsos: CacheDirContent, cache_file_path: str) -> bool:
     """Check whether or not we need to update the cache.
 
     We keep what's in the cache through a JSON file stored at the root
     of the cache_dir. We consider a dynamically shared object to be up
     to date if its name, its full path, its size and last modification
-    timestamp are equivalent."""
+    timestamp are equivalent. If only the last modification timestamp
+    differs, we compare the DSO content hash."""
     log_info("Checking if the cache is up to date")
-    if os.path.isfile(cache_file_path):
-        with open(cache_file_path, "r", encoding="utf8") as f:
-            try:
-                cached_dsos: CacheDirContent = CacheDirContent.from_json(f.read())
-            except:
-                return False
-            return dsos == cached_dsos
-    return False
+    cached_dsos = read_cache_content(cache_file_path)
+    if cached_dsos is None:
+        return False
+    stale, _, removed = dsos.diff(cached_dsos)
+    return not stale and not removed
+
+
+def hash_dso_content(path: str) -> str:
+    """Hashes the content of the PATH file.
+
+    We're only using this hash to detect DSOs content changes, we
+    don't need a cryptographically strong hash function here:
+    blake2b is fast enough."""
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def library_path_hash(path: str) -> str:
+    """Name of the cache directory mirroring the PATH host library
+    path.
+
+    64 bits are more than enough to prevent any collision between the
+    host library paths."""
+    return hashlib.sha256(path.encode("utf8")).hexdigest()[:16]
 
 
 def cache_library_path(
-    library_path: LibraryPath, temp_cache_dir_root: str, final_cache_dir_root: str
+    library_path: LibraryPath,
+    temp_cache_dir_root: str,
+    final_cache_dir_root: str,
+    cached_library_path: LibraryPath | None = None,
 ) -> str:
     """Generate a cache directory for the LIBRARY_PATH host directory.
 
@@ -318,31 +509,65 @@ def cache_library_path(
     the graphics card drivers. Its full name is hashed: it's an
     attempt to keep the final LD_LIBRARY_PATH reasonably sized.
 
+    If CACHED_LIBRARY_PATH is set, it describes the current content
+    of the FINAL_CACHE_DIR_ROOT cache directory for this host
+    directory. The DSOs that did not change are re-used from there.
+
     Returns the name of the cache directory created by this
     function to CACHE_DIR_ROOT."""
+    log_info(f"Caching {library_path}")
     # Hash Computation
-    h = hashlib.sha256()
-    h.update(library_path.path.encode("utf8"))
-    path_hash: str = h.hexdigest()
+    path_hash: str = library_path_hash(library_path.path)
     # Paths
     cache_path_root: str = os.path.join(temp_cache_dir_root, path_hash)
-    lib_dir = os.path.join(cache_path_root, "lib")
-    rpath_lib_dir = os.path.join(final_cache_dir_root, path_hash, "lib")
-    cuda_dir = os.path.join(cache_path_root, "cuda")
-    egl_dir = os.path.join(cache_path_root, "egl")
-    glx_dir = os.path.join(cache_path_root, "glx")
-    # Copy and patch DSOs
-    for dsos, d in [
-        (library_path.generic, lib_dir),
-        (library_path.cuda, cuda_dir),
-        (library_path.egl, egl_dir),
-        (library_path.glx, glx_dir),
+    final_cache_path_root: str = os.path.join(final_cache_dir_root, path_hash)
+    rpath_lib_dir = os.path.join(final_cache_path_root, "lib")
+    # Copy DSOs
+    all_new_paths: list[str] = []
+    for dsos, cached_dsos, subdir in [
+        (
+            library_path.generic,
+            cached_library_path.generic if cached_library_path else None,
+            "lib",
+        ),
+        (
+            library_path.cuda,
+            cached_library_path.cuda if cached_library_path else None,
+            "cuda",
+        ),
+        (
+            library_path.egl,
+            cached_library_path.egl if cached_library_path else None,
+            "egl",
+        ),
+        (
+            library_path.glx,
+            cached_library_path.glx if cached_library_path else None,
+            "glx",
+        ),
     ]:
+        d = os.path.join(cache_path_root, subdir)
         os.makedirs(d, exist_ok=True)
         if len(dsos) > 0:
-            copy_and_patch_libs(dsos=dsos, dest_dir=d, rpath=rpath_lib_dir)
+            all_new_paths.extend(
+                copy_libs(
+                    dsos=dsos,
+                    dest_dir=d,
+                    cached_dsos=cached_dsos,
+                    cached_dir=os.path.join(final_cache_path_root, subdir),
+                )
+            )
         else:
-            log_info(f"Did not find any DSO to put in {d}, skipping copy and patching.")
+            log_info(f"Did not find any DSO to put in {d}, skipping copy.")
+    # Patch DSOs. They all share the same runpath: a single patchelf
+    # run is enough.
+    if len(all_new_paths) > 0:
+        patch_dsos(all_new_paths, rpath_lib_dir)
+    # Storing the DSOs content hashes in the cache metadata: they'll
+    # be used to check whether a DSO really changed when its
+    # modification time does.
+    for dso in library_path.all_dsos():
+        dso.get_content_hash()
     return path_hash
 
 
@@ -371,29 +596,45 @@ def generate_cache_metadata(
 
     The metadata being:
 
-    - CACHE_DIR/cache.json: json file containing all the paths info.
+    - CACHE_DIR/cache.json: json file containing all the paths info
+      and the LD_LIBRARY_PATH to inject for the CACHE_PATHS.
     - CACHE_DIR/ld_library_path: file containing the LD_LIBRARY_PATH
-      to inject for the CACHE_PATHS.
+      to inject for the CACHE_PATHS. We're not reading it anymore,
+      it's kept for the external consumers.
     - CACHE_DIR/egl-confs: directory containing the various EGL
-      confs."""
+      confs.
+
+    The cache.json file is written last: the cache is not considered
+    to be valid until it gets written."""
     cache_file_path = os.path.join(cache_dir, "cache.json")
     cached_ld_library_path = os.path.join(cache_dir, "ld_library_path")
     egl_conf_dir = os.path.join(cache_dir, "egl-confs")
-    with open(cache_file_path, "w", encoding="utf8") as f:
-        f.write(cache_content.to_json())
     nix_gl_ld_library_path = generate_cache_ld_library_path(cache_paths)
     log_info(f"Caching LD_LIBRARY_PATH: {nix_gl_ld_library_path}")
     with open(cached_ld_library_path, "w", encoding="utf8") as f:
         f.write(nix_gl_ld_library_path)
     generate_nvidia_egl_config_files(egl_conf_dir)
+    cache_content.ld_library_path = nix_gl_ld_library_path
+    # Atomically replacing cache.json: the concurrent readers will
+    # never see a partially written file.
+    tmp_cache_file_path = f"{cache_file_path}.tmp"
+    with open(tmp_cache_file_path, "w", encoding="utf8") as f:
+        f.write(cache_content.to_json())
+    os.replace(tmp_cache_file_path, cache_file_path)
     return nix_gl_ld_library_path
 
 
-def exec_binary(bin_path: str, args: list[str]) -> None:
+def exec_binary(
+    bin_path: str, args: list[str], env: dict[str, str] | None = None
+) -> None:
     """Replace the current python program with the program pointed by
     BIN_PATH.
 
-    Sets the relevant libGLvnd env variables."""
+    The program is executed with the ENV environment if set, with the
+    current one otherwise."""
     log_info(f"Execv-ing {bin_path}")
     log_info(f"Goodbye now.")
-    os.execvp(bin_path, [bin_path] + args)
+    if env is not None:
+        os.execvpe(bin_path, [bin_path] + args, env)
+    else:
+        os.execvp(bin_path, [bin_path] + args)
@@ -1,86 +1,97 @@
 import os
-import shutil
 import fcntl
-import tempfile
 import json
+from concurrent.futures import ThreadPoolExecutor
 
 from nixglhost.util import log_info
 from nixglhost import (
     CacheDirContent,
     LibraryPath,
-    resolve_libraries,
+    ResolvedLib,
+    get_dso_stem,
     generate_cache_metadata,
     cache_library_path,
-    is_dso_cache_up_to_date,
+    read_cache_content,
+    library_path_hash,
     get_ld_paths,
     generate_cache_ld_library_path,
 )
 
-# The following regexes list has been figured out by looking at the
+# The following DSOs names list has been figured out by looking at the
 # output of nix-build -A linuxPackages.nvidia_x11 before running
 # ls ./result/lib | grep -E ".so$".
 #
 # TODO: find a more systematic way to figure out these names *not
 # requiring to build/fetch the nvidia driver at runtime*.
-# TODO: compile the regexes
-NVIDIA_DSO_PATTERNS = [
-    r"libGLESv1_CM_nvidia\.so.*$",
-    r"libGLESv2_nvidia\.so.*$",
-    r"libglxserver_nvidia\.so.*$",
-    r"libnvcuvid\.so.*$",
-    r"libnvidia-allocator\.so.*$",
-    r"libnvidia-cfg\.so.*$",
-    r"libnvidia-compiler\.so.*$",
-    r"libnvidia-eglcore\.so.*$",
-    r"libnvidia-encode\.so.*$",
-    r"libnvidia-fbc\.so.*$",
-    r"libnvidia-glcore\.so.*$",
-    r"libnvidia-glsi\.so.*$",
-    r"libnvidia-glvkspirv\.so.*$",
-    r"libnvidia-gpucomp\.so.*$",
-    r"libnvidia-ml\.so.*$",
-    r"libnvidia-ngx\.so.*$",
-    r"libnvidia-nvvm\.so.*$",
-    r"libnvidia-opencl\.so.*$",
-    r"libnvidia-opticalflow\.so.*$",
-    r"libnvidia-ptxjitcompiler\.so.*$",
-    r"libnvidia-rtcore\.so.*$",
-    r"libnvidia-tls\.so.*$",
-    r"libnvidia-vulkan-producer\.so.*$",
-    r"libnvidia-wayland-client\.so.*$",
-    r"libnvoptix\.so.*$",
-    # Cannot find that one :(
-    r"libnvtegrahv\.so.*$",
-    # Host dependencies required by the nvidia DSOs to properly
-    # operate
-    # libdrm
-    r"libdrm\.so.*$",
-    # libffi
-    r"libffi\.so.*$",
-    # libgbm
-    r"libgbm\.so.*$",
-    # libexpat
-    r"libexpat\.so.*$",
-    # libxcb
-    r"libxcb-glx\.so.*$",
-    # Coming from libx11
-    r"libX11-xcb\.so.*$",
-    r"libX11\.so.*$",
-    r"libXext\.so.*$",
-    # libwayland
-    r"libwayland-server\.so.*$",
-    r"libwayland-client\.so.*$",
-]
-
-NVIDIA_CUDA_DSO_PATTERNS = [r"libcudadebugger\.so.*$", r"libcuda\.so.*$"]
-
-NVIDIA_GLX_DSO_PATTERNS = [r"libGLX_nvidia\.so.*$"]
-
-NVIDIA_EGL_DSO_PATTERNS = [
-    r"libEGL_nvidia\.so.*$",
-    r"libnvidia-egl-wayland\.so.*$",
-    r"libnvidia-egl-gbm\.so.*$",
-]
+NVIDIA_DSO_PREFIXES = frozenset(
+    {
+        "libGLESv1_CM_nvidia",
+        "libGLESv2_nvidia",
+        "libglxserver_nvidia",
+        "libnvcuvid",
+        "libnvidia-allocator",
+        "libnvidia-cfg",
+        "libnvidia-compiler",
+        "libnvidia-eglcore",
+        "libnvidia-encode",
+        "libnvidia-fbc",
+        "libnvidia-glcore",
+        "libnvidia-glsi",
+        "libnvidia-glvkspirv",
+        "libnvidia-gpucomp",
+        "libnvidia-ml",
+        "libnvidia-ngx",
+        "libnvidia-nvvm",
+        "libnvidia-opencl",
+        "libnvidia-opticalflow",
+        "libnvidia-ptxjitcompiler",
+        "libnvidia-rtcore",
+        "libnvidia-tls",
+        "libnvidia-vulkan-producer",
+        "libnvidia-wayland-client",
+        "libnvoptix",
+        # Cannot find that one :(
+        "libnvtegrahv",
+        # Host dependencies required by the nvidia DSOs to properly
+        # operate
+        # libdrm
+        "libdrm",
+        # libffi
+        "libffi",
+        # libgbm
+        "libgbm",
+        # libexpat
+        "libexpat",
+        # libxcb
+        "libxcb-glx",
+        # Coming from libx11
+        "libX11-xcb",
+        "libX11",
+        "libXext",
+        # libwayland
+        "libwayland-server",
+        "libwayland-client",
+    }
+)
+
+NVIDIA_CUDA_DSO_PREFIXES = frozenset({"libcudadebugger", "libcuda"})
+
+NVIDIA_GLX_DSO_PREFIXES = frozenset({"libGLX_nvidia"})
+
+NVIDIA_EGL_DSO_PREFIXES = frozenset(
+    {
+        "libEGL_nvidia",
+        "libnvidia-egl-wayland",
+        "libnvidia-egl-gbm",
+    }
+)
+
+_NVIDIA_DSO_PREFIXES = (
+    NVIDIA_DSO_PREFIXES
+    | NVIDIA_CUDA_DSO_PREFIXES
+    | NVIDIA_GLX_DSO_PREFIXES
+    | NVIDIA_EGL_DSO_PREFIXES
+)
 
 
 def generate_nvidia_egl_config_files(egl_conf_dir: str) -> None:
@@ -90,7 +101,10 @@ def generate_nvidia_egl_config_files(egl_conf_dir: str) -> None:
     These configuration files will point to the EGL, wayland and GBM
     Nvidia DSOs. We're only specifying the DSOs names here to give the
     linker enough legroom to load the most appropriate DSO from the
-    LD_LIBRARY_PATH."""
+    LD_LIBRARY_PATH.
+
+    The files already containing the expected configuration are left
+    untouched."""
 
     def generate_egl_conf_json(dso):
         return json.dumps(
@@ -103,30 +117,72 @@ def generate_nvidia_egl_config_files(egl_conf_dir: str) -> None:
         ("15_nvidia_gbm.json", f"libnvidia-egl-gbm.so.1"),
     ]
 
+    os.makedirs(egl_conf_dir, exist_ok=True)
     for conf_file_name, dso_name in dso_paths:
-        os.makedirs(egl_conf_dir, exist_ok=True)
-        with open(
-            os.path.join(egl_conf_dir, conf_file_name), "w", encoding="utf-8"
-        ) as f:
+        conf_file_path = os.path.join(egl_conf_dir, conf_file_name)
+        conf = generate_egl_conf_json(dso_name)
+        try:
+            with open(conf_file_path, "r", encoding="utf-8") as f:
+                if f.read() == conf:
+                    continue
+        except FileNotFoundError:
+            pass
+        with open(conf_file_path, "w", encoding="utf-8") as f:
             log_info(f"Writing {dso_name} conf to {egl_conf_dir}")
-            f.write(generate_egl_conf_json(dso_name))
+            f.write(conf)
 
 
 def scan_dsos_from_dir(path: str) -> LibraryPath | None:
     """Look for the different kind of DSOs we're searching in a
     particular library path.
-    This will match and hash the content of each object we're
-    interested in."""
-    generic = resolve_libraries(path, NVIDIA_DSO_PATTERNS)
+
+    We're doing a single pass on the directory: the DSOs metadata is
+    retrieved from the directory entries, sparing us a couple of
+    syscalls per file."""
+    abs_path = os.path.abspath(path)
+    generic: list[ResolvedLib] = []
+    cuda: list[ResolvedLib] = []
+    glx: list[ResolvedLib] = []
+    egl: list[ResolvedLib] = []
+    with os.scandir(path) as it:
+        for entry in it:
+            stem = get_dso_stem(entry.name)
+            # Note: we're following the symlinks on purpose, the
+            # host DSOs are usually exposed through a chain of
+            # symlinks (libcuda.so -> libcuda.so.1 -> libcuda.so.xxx).
+            if stem not in _NVIDIA_DSO_PREFIXES or not entry.is_file():
+                continue
+            buckets = [
+                bucket
+                for bucket, prefixes in [
+                    (generic, NVIDIA_DSO_PREFIXES),
+                    (cuda, NVIDIA_CUDA_DSO_PREFIXES),
+                    (glx, NVIDIA_GLX_DSO_PREFIXES),
+                    (egl, NVIDIA_EGL_DSO_PREFIXES),
+                ]
+                if stem in prefixes
+            ]
+            st = entry.stat()
+            dso = ResolvedLib(
+                name=entry.name,
+                dirpath=path,
+                fullpath=os.path.join(abs_path, entry.name),
+                last_modification=st.st_mtime,
+                size=st.st_size,
+            )
+            for bucket in buckets:
+                bucket.append(dso)
     if len(generic) > 0:
-        cuda = resolve_libraries(path, NVIDIA_CUDA_DSO_PATTERNS)
-        glx = resolve_libraries(path, NVIDIA_GLX_DSO_PATTERNS)
-        egl = resolve_libraries(path, NVIDIA_EGL_DSO_PATTERNS)
         return LibraryPath(glx=glx, cuda=cuda, generic=generic, egl=egl, path=path)
     else:
         return None
 
 
+def max_workers(nb_jobs: int) -> int:
+    """Number of threads used to process NB_JOBS concurrent jobs."""
+    return max(1, min(8, nb_jobs))
+
+
 def generate_cache_metadata(
     cache_dir: str, cache_content: CacheDirContent, cache_paths: list[str]
 ) -> str:
@@ -135,24 +191,178 @@ def generate_cache_metadata(
 
     The metadata being:
 
-    - CACHE_DIR/cache.json: json file containing all the paths info.
+    - CACHE_DIR/cache.json: json file containing all the paths info
+      and the LD_LIBRARY_PATH to inject for the CACHE_PATHS.
     - CACHE_DIR/ld_library_path: file containing the LD_LIBRARY_PATH
-      to inject for the CACHE_PATHS.
+      to inject for the CACHE_PATHS. We're not reading it anymore,
+      it's kept for the external consumers.
     - CACHE_DIR/egl-confs: directory containing the various EGL
-      confs."""
+      confs.
+
+    The cache.json file is written last: the cache is not considered
+    to be valid until it gets written."""
     cache_file_path = os.path.join(cache_dir, "cache.json")
     cached_ld_library_path = os.path.join(cache_dir, "ld_library_path")
     egl_conf_dir = os.path.join(cache_dir, "egl-confs")
-    with open(cache_file_path, "w", encoding="utf8") as f:
-        f.write(cache_content.to_json())
     nix_gl_ld_library_path = generate_cache_ld_library_path(cache_paths)
     log_info(f"Caching LD_LIBRARY_PATH: {nix_gl_ld_library_path}")
     with open(cached_ld_library_path, "w", encoding="utf8") as f:
         f.write(nix_gl_ld_library_path)
     generate_nvidia_egl_config_files(egl_conf_dir)
+    cache_content.ld_library_path = nix_gl_ld_library_path
+    # Atomically replacing cache.json: the concurrent readers will
+    # never see a partially written file.
+    tmp_cache_file_path = f"{cache_file_path}.tmp"
+    with open(tmp_cache_file_path, "w", encoding="utf8") as f:
+        f.write(cache_content.to_json())
+    os.replace(tmp_cache_file_path, cache_file_path)
+    return nix_gl_ld_library_path
+
+
+def cache_absolute_paths(cache_dir: str, cache_content: CacheDirContent) -> list[str]:
+    """Absolute paths of the CACHE_DIR subdirectories mirroring the
+    CACHE_CONTENT library paths."""
+    return [
+        os.path.join(cache_dir, library_path_hash(p.path)) for p in cache_content.paths
+    ]
+
+
+def regenerate_cache(cache_dir: str, cache_content: CacheDirContent) -> str:
+    """Regenerates the whole CACHE_DIR from scratch for CACHE_CONTENT.
+
+    Returns the associated LD_LIBRARY_PATH."""
+    # We're building first the cache in a temporary directory
+    # to make sure we won't end up with a partially
+    # populated/corrupted nix-gl-host cache.
+    #
+    # The temporary directory lives next to the cache directory: it
+    # has to be on the same filesystem for os.rename to work.
+    #
+    # Note: tempfile is only needed when the cache is stale, we're
+    # not paying for its import on a warm cache run.
+    import tempfile
+
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(cache_dir)) as tmp_cache:
+        tmp_cache_dir = os.path.join(tmp_cache, "nix-gl-host")
+        os.makedirs(tmp_cache_dir)
+        with ThreadPoolExecutor(
+            max_workers=max_workers(len(cache_content.paths))
+        ) as ex:
+            list(
+                ex.map(
+                    lambda p: cache_library_path(p, tmp_cache_dir, cache_dir),
+                    cache_content.paths,
+                )
+            )
+        # Pointing the LD_LIBRARY_PATH to the final destination
+        # instead of the tmp dir.
+        nix_gl_ld_library_path = generate_cache_metadata(
+            tmp_cache_dir, cache_content, cache_absolute_paths(cache_dir, cache_content)
+        )
+        # The temporary cache has been successfully populated,
+        # let's swap it with the actual nix-gl-host cache.
+        # Note: The rename operations are atomic on linux. The old
+        # cache is moved to the temporary directory, it'll get
+        # deleted with it.
+        log_info(f"Mv {tmp_cache_dir} to {cache_dir}")
+        if os.path.exists(cache_dir):
+            os.rename(cache_dir, os.path.join(tmp_cache, "nix-gl-host.old"))
+        os.rename(tmp_cache_dir, cache_dir)
     return nix_gl_ld_library_path
 
 
+def update_cache(
+    cache_dir: str,
+    cache_content: CacheDirContent,
+    cached_content: CacheDirContent,
+    stale_paths: list[LibraryPath],
+    removed_paths: list[LibraryPath],
+) -> str:
+    """Incrementally updates CACHE_DIR, currently containing
+    CACHED_CONTENT, to match CACHE_CONTENT.
+
+    Only the STALE_PATHS library paths are re-cached, the
+    REMOVED_PATHS ones are deleted. The other cache subdirectories are
+    left untouched. The stale library paths DSOs that did not change
+    are hardlinked from their current cache subdirectory.
+
+    The stale subdirectories are built in a temporary directory
+    living next to CACHE_DIR, they are then atomically moved to
+    CACHE_DIR.
+
+    Returns the associated LD_LIBRARY_PATH."""
+    import tempfile
+
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(cache_dir)) as tmp_cache_dir:
+        with ThreadPoolExecutor(max_workers=max_workers(len(stale_paths))) as ex:
+            cached_paths = {p.path: p for p in cached_content.paths}
+            stale_hashes: list[str] = list(
+                ex.map(
+                    lambda p: cache_library_path(
+                        p, tmp_cache_dir, cache_dir, cached_paths.get(p.path)
+                    ),
+                    stale_paths,
+                )
+            )
+        removed_hashes = [library_path_hash(p.path) for p in removed_paths]
+        for path_hash in stale_hashes + removed_hashes:
+            old_path = os.path.join(cache_dir, path_hash)
+            if os.path.exists(old_path):
+                # Moving the outdated subdirectory to the temporary
+                # directory, it'll get deleted with it.
+                os.rename(old_path, os.path.join(tmp_cache_dir, f"{path_hash}.old"))
+        for path_hash in stale_hashes:
+            log_info(f"Mv {path_hash} to {cache_dir}")
+            os.rename(
+                os.path.join(tmp_cache_dir, path_hash),
+                os.path.join(cache_dir, path_hash),
+            )
+    return generate_cache_metadata(
+        cache_dir, cache_content, cache_absolute_paths(cache_dir, cache_content)
+    )
+
+
+def sync_cache(
+    cache_dir: str, cache_content: CacheDirContent, read_only: bool = False
+) -> str | None:
+    """Makes sure CACHE_DIR is up to date with the CACHE_CONTENT we
+    scanned from the host system.
+
+    Returns the LD_LIBRARY_PATH pointing to the cached DSOs. In
+    READ_ONLY mode, returns None if the cache has to be updated."""
+    cache_file_path = os.path.join(cache_dir, "cache.json")
+    cached_content = read_cache_content(cache_file_path)
+    if cached_content is None or cached_content.version != cache_content.version:
+        log_info("The cache is not up to date, regenerating it")
+        if read_only:
+            return None
+        return regenerate_cache(cache_dir, cache_content)
+    stale_paths, fresh_paths, removed_paths = cache_content.diff(cached_content)
+    # Someone may have tampered with the cache directory.
+    for p in fresh_paths:
+        if not os.path.isdir(os.path.join(cache_dir, library_path_hash(p.path))):
+            stale_paths.append(p)
+    # Note: the cache content may differ from the cached one while
+    # being up to date if some DSOs modification time changed without
+    # their content changing. We want to persist the new modification
+    # times in that case.
+    if stale_paths or removed_paths or cache_content != cached_content:
+        log_info(f"The cache is not up to date, updating {stale_paths}")
+        if read_only:
+            return None
+        log_info(f"Removing {removed_paths} from the cache")
+        return update_cache(
+            cache_dir, cache_content, cached_content, stale_paths, removed_paths
+        )
+    if cached_content.ld_library_path is None:
+        log_info("The cached LD_LIBRARY_PATH is missing, regenerating it")
+        if read_only:
+            return None
+        return update_cache(cache_dir, cache_content, cached_content, [], [])
+    log_info("The cache is up to date, re-using it.")
+    return cached_content.ld_library_path
+
+
 def nvidia_main(
     cache_dir: str, dso_vendor_paths: list[str], print_ld_library_path: bool = False
 ) -> dict:
@@ -183,60 +393,53 @@ def nvidia_main(
     # Find Host DSOS
     log_info("Searching for the host DSOs")
     cache_content: CacheDirContent = CacheDirContent(paths=[])
-    cache_file_path = os.path.join(cache_dir, "cache.json")
     lock_path = os.path.join(os.path.split(cache_dir)[0], "nix-gl-host.lock")
-    cached_ld_library_path = os.path.join(cache_dir, "ld_library_path")
-    paths = get_ld_paths()
+    # Some library paths may point to the same directory through
+    # symlinks (IE. /lib -> /usr/lib on merged-usr systems), we only
+    # scan them once.
+    scanned_paths: set[str] = set()
+    paths: list[str] = []
+    for path in get_ld_paths():
+        real_path = os.path.realpath(path)
+        if real_path not in scanned_paths:
+            scanned_paths.add(real_path)
+            paths.append(path)
     egl_conf_dir = os.path.join(cache_dir, "egl-confs")
     nix_gl_ld_library_path: str | None = None
     # Cache/Patch DSOs
     #
     # We need to be super careful about race conditions here. We're
     # using a file lock to make sure only one nix-gl-host instance can
-    # access the cache at a time.
+    # write to the cache at a time.
+    #
+    # We first take a shared lock to check whether the cache is up to
+    # date: the concurrent cache hits are not blocking each other. We
+    # only upgrade it to an exclusive lock if we need to update the
+    # cache.
     #
     # If the cache is locked, we'll wait until the said lock is
     # released. The lock will always be released when the lock FD get
     # closed, IE. when we'll get out of this block.
     with open(lock_path, "w") as lock:
-        log_info("Acquiring the cache lock")
-        fcntl.flock(lock, fcntl.LOCK_EX)
-        log_info("Cache lock acquired")
-        for path in paths:
-            res = scan_dsos_from_dir(path)
-            if res:
-                cache_content.paths.append(res)
-        if not is_dso_cache_up_to_date(
-            cache_content, cache_file_path
-        ) or not os.path.isfile(cached_ld_library_path):
-            log_info("The cache is not up to date, regenerating it")
-            # We're building first the cache in a temporary directory
-            # to make sure we won't end up with a partially
-            # populated/corrupted nix-gl-host cache.
-            with tempfile.TemporaryDirectory() as tmp_cache:
-                tmp_cache_dir = os.path.join(tmp_cache, "nix-gl-host")
-                os.makedirs(tmp_cache_dir)
-                cache_paths: list[str] = []
-                for p in cache_content.paths:
-                    log_info(f"Caching {p}")
-                    cache_paths.append(cache_library_path(p, tmp_cache_dir, cache_dir))
-                # Pointing the LD_LIBRARY_PATH to the final destination
-                # instead of the tmp dir.
-                cache_absolute_paths = [os.path.join(cache_dir, p) for p in cache_paths]
-                nix_gl_ld_library_path = generate_cache_metadata(
-                    tmp_cache_dir, cache_content, cache_absolute_paths
-                )
-                # The temporary cache has been successfully populated,
-                # let's mv it to the actual nix-gl-host cache.
-                # Note: The move operation is atomic on linux.
-                log_info(f"Mv {tmp_cache_dir} to {cache_dir}")
-                if os.path.exists(cache_dir):
-                    shutil.rmtree(cache_dir)
-                shutil.move(tmp_cache_dir, os.path.split(cache_dir)[0])
-        else:
-            log_info("The cache is up to date, re-using it.")
-            with open(cached_ld_library_path, "r", encoding="utf8") as f:
-                nix_gl_ld_library_path = f.read()
+        log_info("Acquiring the shared cache lock")
+        fcntl.flock(lock, fcntl.LOCK_SH)
+        log_info("Shared cache lock acquired")
+        # The library paths are independent from each other, we're
+        # scanning and caching them concurrently.
+        with ThreadPoolExecutor(max_workers=max_workers(len(paths))) as ex:
+            for res in ex.map(scan_dsos_from_dir, paths):
+                if res:
+                    cache_content.paths.append(res)
+        nix_gl_ld_library_path = sync_cache(cache_dir, cache_content, read_only=True)
+        if nix_gl_ld_library_path is None:
+            # Note: flock lock conversions are not atomic. Another
+            # instance may update the cache in between, sync_cache
+            # is re-checking the cache state.
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            log_info("Acquiring the exclusive cache lock")
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            log_info("Exclusive cache lock acquired")
+            nix_gl_ld_library_path = sync_cache(cache_dir, cache_content)
     log_info("Cache lock released")
 
     assert nix_gl_ld_library_path, "The nix-host-gl LD_LIBRARY_PATH is not set"
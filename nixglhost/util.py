@@ -1,8 +1,14 @@
 import os
+import sys
+
+# The environment is not supposed to change during the process
+# lifetime. Checked once, the hot paths can skip formatting their log
+# messages altogether.
+DEBUG = "DEBUG" in os.environ
 
 
 def log_info(string: str) -> None:
     """Prints STR to STDERR if the DEBUG environment variable is
     set."""
-    if "DEBUG" in os.environ:
-        print(f"[+] {string}")
+    if DEBUG:
+        print(f"[+] {string}", file=sys.stderr)
@@ -1,7 +1,15 @@
 import unittest
 import os
+import tempfile
 
 from nixglhost import CacheDirContent, LibraryPath, ResolvedLib
+from nixglhost import get_dso_stem
+from nixglhost.nvidia import (
+    NVIDIA_DSO_PREFIXES,
+    NVIDIA_CUDA_DSO_PREFIXES,
+    NVIDIA_GLX_DSO_PREFIXES,
+    NVIDIA_EGL_DSO_PREFIXES,
+)
 
 
 class TestCacheSerializer(unittest.TestCase):
@@ -69,6 +77,70 @@ class TestCacheSerializer(unittest.TestCase):
         self.assertNotEqual(cdc, wrong_cdc)
         self.assertNotEqual(commut_cdc, wrong_cdc)
 
+    def test_diff_cache_content(self):
+        """Checks the cache content diff is done at the library path level"""
+        cwd = os.path.dirname(os.path.realpath(__file__))
+        with open(
+            os.path.join(cwd, "fixtures", "json_permut", "1.json"),
+            "r",
+            encoding="utf8",
+        ) as f:
+            cdc = CacheDirContent.from_json(f.read())
+        with open(
+            os.path.join(cwd, "fixtures", "json_permut", "not-equal.json"),
+            "r",
+            encoding="utf8",
+        ) as f:
+            wrong_cdc = CacheDirContent.from_json(f.read())
+        stale, fresh, removed = cdc.diff(wrong_cdc)
+        self.assertEqual([p.path for p in stale], ["/path/to/lib/dir"])
+        self.assertEqual([p.path for p in fresh], ["/path/to/lib/dir2"])
+        self.assertEqual(removed, [])
+        stale, fresh, removed = CacheDirContent(cdc.paths[:1], cdc.version).diff(cdc)
+        self.assertEqual(stale, [])
+        self.assertEqual([p.path for p in fresh], ["/path/to/lib/dir"])
+        self.assertEqual([p.path for p in removed], ["/path/to/lib/dir2"])
+        stale, fresh, removed = CacheDirContent(cdc.paths, version=0).diff(cdc)
+        self.assertEqual(len(stale), 2)
+        self.assertEqual(fresh, [])
+        self.assertEqual(len(removed), 2)
+
+
+class TestResolvedLib(unittest.TestCase):
+    def test_mtime_change_falls_back_to_content_hash(self):
+        """Checks a touched but unmodified DSO is considered up to date"""
+        with tempfile.TemporaryDirectory() as d:
+            fullpath = os.path.join(d, "libcuda.so.1")
+            with open(fullpath, "wb") as f:
+                f.write(b"dummy content")
+            cached = ResolvedLib.from_path("libcuda.so.1", d, fullpath)
+            cached.get_content_hash()
+            touched = ResolvedLib(
+                "libcuda.so.1", d, fullpath, cached.last_modification + 1, cached.size
+            )
+            self.assertNotEqual(touched, cached)
+            self.assertTrue(touched.is_up_to_date(cached))
+            with open(fullpath, "wb") as f:
+                f.write(b"other content")
+            modified = ResolvedLib(
+                "libcuda.so.1", d, fullpath, cached.last_modification + 1, cached.size
+            )
+            self.assertFalse(modified.is_up_to_date(cached))
+
+
+class TestDsoPrefixes(unittest.TestCase):
+    def test_prefixes_classification(self):
+        """Checks the DSOs are dispatched to the right category"""
+        self.assertIn(get_dso_stem("libnvidia-ml.so.1"), NVIDIA_DSO_PREFIXES)
+        self.assertIn(get_dso_stem("libX11.so"), NVIDIA_DSO_PREFIXES)
+        self.assertNotIn(get_dso_stem("libGLX_nvidia.so.0"), NVIDIA_DSO_PREFIXES)
+        self.assertIn(get_dso_stem("libcuda.so.535.86.05"), NVIDIA_CUDA_DSO_PREFIXES)
+        self.assertNotIn(get_dso_stem("libcudart.so.12"), NVIDIA_CUDA_DSO_PREFIXES)
+        self.assertIn(get_dso_stem("libGLX_nvidia.so.0"), NVIDIA_GLX_DSO_PREFIXES)
+        self.assertIn(get_dso_stem("libnvidia-egl-gbm.so.1"), NVIDIA_EGL_DSO_PREFIXES)
+        self.assertNotIn(get_dso_stem("libEGL.so.1"), NVIDIA_EGL_DSO_PREFIXES)
+        self.assertIsNone(get_dso_stem("libcuda"))
+
 
 if __name__ == "__main__":
     unittest.main()